@@ -7,10 +7,12 @@ import requests
 from requests import ConnectionError
 import hashlib
 import json
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+from bisect import bisect_left, bisect_right
 import os
 import time
 import re
+import threading
 
 __author__ = "David Brawand"
 __credits__ = ['David Brawand']
@@ -22,8 +24,9 @@ __email__ = "dbrawand@nhs.net"
 class ApiError(Exception):
     """Exception raised for errors in or while using the SQVD API"""
 
-    def __init__(self, message):
+    def __init__(self, message, status=None):
         super(ApiError, self).__init__(message)
+        self.status = status
 
 
 def safeKeys(iterable):
@@ -45,45 +48,185 @@ def safeKeys(iterable):
     return iterable
 
 
-def weekdaysFromNow(days):
+def _asDate(day):
+    """Converts a datetime, date or ISO string (YYYY-MM-DD) to a date
+
+    :param day: day to convert.
+    :type day: datetime/date/str.
+    :returns:  date.
+    """
+    if isinstance(day, datetime):
+        return day.date()
+    if isinstance(day, date):
+        return day
+    return datetime.strptime(str(day)[:10], '%Y-%m-%d').date()
+
+
+class BusinessCalendar(object):
+    """Business day calendar with configurable weekend and holidays.
+
+    Due dates are computed in closed form (whole weeks are skipped in a single
+    step, holidays are counted with a binary search) and memoised per
+    (start, days) so that bulk bookings do not recompute identical offsets.
+    As with numpy.busday_offset, days are counted strictly after the start.
+    """
+
+    CACHESIZE = 4096  # cached due dates, cleared when full
+
+    def __init__(self, holidays=None, weekmask=(0, 1, 2, 3, 4)):
+        """creates a business day calendar
+
+        :param holidays: Non-working days (eg. bank holidays)
+        :type holidays: [datetime/date/str].
+        :param weekmask: Working weekdays (Monday is 0)
+        :type weekmask: (int).
+        """
+        self.weekmask = frozenset(weekmask)
+        if not self.weekmask or not self.weekmask <= set(range(7)):
+            raise ValueError('weekmask must be a non-empty subset of 0-6')
+        self.holidays = []
+        self._cache = {}
+        self.addHolidays(holidays or [])
+
+    def addHolidays(self, holidays):
+        """Adds holidays to the calendar (invalidates cached due dates)
+
+        :param holidays: Non-working days
+        :type holidays: [datetime/date/str].
+        """
+        days = set(self.holidays)
+        days.update(_asDate(h) for h in holidays)
+        # holidays on non-working days do not shift due dates
+        self.holidays = sorted(d for d in days if d.weekday() in self.weekmask)
+        self._cache = {}
+
+    def isBusinessDay(self, day):
+        """Checks if a day is a working day
+
+        :param day: day to check.
+        :type day: datetime/date/str.
+        :returns:  bool.
+        """
+        day = _asDate(day)
+        if day.weekday() not in self.weekmask:
+            return False
+        i = bisect_left(self.holidays, day)
+        return not (i < len(self.holidays) and self.holidays[i] == day)
+
+    def _offset(self, start, days):
+        """Adds working days to a date ignoring holidays
+
+        :param start: start day.
+        :type start: date.
+        :param days: working days to add (>0).
+        :type days: int.
+        :returns:  date.
+        """
+        perweek = len(self.weekmask)
+        weeks = (days - 1) // perweek
+        days -= weeks * perweek
+        end = start + timedelta(days=7 * weeks)
+        while days > 0:  # at most 7 steps
+            end += timedelta(days=1)
+            if end.weekday() in self.weekmask:
+                days -= 1
+        return end
+
+    def add(self, start, days):
+        """Returns the start day with the number of business days added
+
+        :param start: start day.
+        :type start: datetime/date/str.
+        :param days: business days to add.
+        :type days: int.
+        :returns:  like start (date if given as string).
+        """
+        days = int(days)
+        if days < 0:
+            raise ValueError('cannot subtract business days')
+        day = _asDate(start)
+        key = (day, days)
+        if key not in self._cache:
+            if len(self._cache) >= self.CACHESIZE:
+                self._cache = {}
+            end = day
+            if days > 0:
+                end = self._offset(day, days)
+                # push forward by holidays falling into the added interval
+                lo = day
+                while True:
+                    skipped = bisect_right(self.holidays, end) - \
+                        bisect_right(self.holidays, lo)
+                    if not skipped:
+                        break
+                    lo, end = end, self._offset(end, skipped)
+            self._cache[key] = end
+        end = self._cache[key]
+        if isinstance(start, datetime):
+            return start + (end - day)
+        return end
+
+    def addMany(self, starts, days):
+        """Batch version of add
+
+        :param starts: start days (or a single start day for all).
+        :type starts: [datetime/date/str].
+        :param days: business days to add (or a single value for all).
+        :type days: [int].
+        :returns:  list.
+        """
+        if isinstance(starts, (datetime, date) + string_types):
+            starts = [starts] * (1 if isinstance(days, int) else len(days))
+        if isinstance(days, int):
+            days = [days] * len(starts)
+        if len(starts) != len(days):
+            raise ValueError('starts and days differ in length')
+        return [self.add(s, d) for s, d in zip(starts, days)]
+
+
+CALENDAR = BusinessCalendar()
+
+
+def weekdaysFromNow(days, calendar=None):
     """Returns a datetime object with the number of weekdays added.
 
     :param days: Weekdays to add.
     :type days: int.
+    :param calendar: Business day calendar (default: weekends only)
+    :type calendar: BusinessCalendar.
     :returns:  datetime.
     """
     startdate = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-    while days > 0:
-        startdate += timedelta(days=1)
-        if startdate.weekday() >= 5:  # next if weekend
-            continue
-        days -= 1
-    return startdate
+    return (calendar or CALENDAR).add(startdate, max(int(days), 0))
 
 FILETYPES = ['vcf', 'bam', 'bed', 'bedgraph', 'pdf', 'bw', 'json', 'csv', 'tsv', 'txt']
 
 class SQVD(object):
 
-    def __init__(self, username, password, host, version='v1'):
+    def __init__(self, username, password, host, version='v1', calendar=None):
         """creates pySQVD class
 
         :param username: SQVD username.
         :type username: str.
         :param password: Plain text password
         :type password: str.
-        :param host: SQVD hostname
+        :param host: SQVD hostname (http unless prefixed with https://)
         :type host: str.
         :param version: API version
         :type version: str.
+        :param calendar: Business day calendar for report due dates
+        :type calendar: BusinessCalendar.
         """
-        self.protocol = 'http'
-        self.host = self.protocol+'://'+host
+        m = re.match(r'(https?)://(.+)$', host)
+        self.protocol = m.group(1) if m else 'http'
+        self.host = self.protocol+'://'+(m.group(2) if m else host).rstrip('/')
         self.url = "/".join([self.host, 'api', version])
         self.gql = "/".join([self.host, 'graphql'])
         self.session = None
         self.userid = None
         self.username = username
         self.password = hashlib.sha256(password.encode('utf-8')).hexdigest()
+        self.calendar = calendar or CALENDAR
 
     def __enter__(self):
         logged_in = self.login()
@@ -162,7 +305,7 @@ class SQVD(object):
         """
         if response.status_code in [200]:
             return True
-        raise ApiError(response.text)
+        raise ApiError(response.text, response.status_code)
 
     def rest(self, collection, op='GET', data=None, json=None):
         """This function does something.
@@ -224,9 +367,9 @@ class SQVD(object):
             assert set(x['subpanels']) <= set(
                 map(lambda x: x['subpanel_id'], panel['data'][0]['subpanels']))
             try:
-                duedate = weekdaysFromNow(int(panel['data'][0]['tat']))
+                duedate = weekdaysFromNow(int(panel['data'][0]['tat']), self.calendar)
             except:
-                duedate = weekdaysFromNow(0)
+                duedate = weekdaysFromNow(0, self.calendar)
         except AssertionError:
             raise ApiError('panel or subpanels not found')
         except:
@@ -405,6 +548,364 @@ class SQVD(object):
             return results
 
 
+class _PoolNode(object):
+    """Book keeping for a single host in a SQVDPool"""
+
+    def __init__(self, client):
+        self.client = client
+        self.outstanding = 0
+        self.requests = 0
+        self.latency = 0.0
+        self.failures = 0
+        self.ejected = None
+
+    def __str__(self):
+        return '<{} outstanding={} latency={:.3f}s{}>'.format(
+            self.client.host, self.outstanding, self.latency,
+            ' ejected' if self.ejected else '')
+
+
+class SQVDPool(SQVD):
+
+    STRATEGIES = ['outstanding', 'latency']
+    FAILUREPENALTY = 4  # failed calls count as this many times the usual latency
+
+    def __init__(self, username, password, hosts, version='v1', calendar=None,
+                 strategy='outstanding', maxFailures=3, ejectTime=30,
+                 healthInterval=10, healthTimeout=5):
+        """creates a pool of SQVD clients with load balancing and failover
+
+        Each call (rest, upload, createStudy, deleteStudy) is routed to a
+        single host with its own authenticated session. Hosts failing with
+        connection errors, server errors (5xx) or rejected authentication
+        are ejected. While logged in, a background thread probes all hosts
+        every healthInterval seconds and re-authenticates ejected hosts
+        after ejectTime.
+
+        :param username: SQVD username.
+        :type username: str.
+        :param password: Plain text password
+        :type password: str.
+        :param hosts: SQVD hostnames (http unless prefixed with https://)
+        :type hosts: [str].
+        :param version: API version
+        :type version: str.
+        :param calendar: Business day calendar for report due dates
+        :type calendar: BusinessCalendar.
+        :param strategy: host selection by least outstanding requests or latency weighted
+        :type strategy: str -- outstanding/latency.
+        :param maxFailures: consecutive failures before a host is ejected
+        :type maxFailures: int.
+        :param ejectTime: seconds before an ejected host is checked again
+        :type ejectTime: float.
+        :param healthInterval: seconds between health checks (0 disables, see checkHealth)
+        :type healthInterval: float.
+        :param healthTimeout: seconds before a health check fails
+        :type healthTimeout: float.
+        """
+        if isinstance(hosts, string_types):
+            hosts = [hosts]
+        if not hosts:
+            raise ApiError('No SQVD hosts given')
+        if strategy not in self.STRATEGIES:
+            raise ApiError('Unknown strategy {} ({})'.format(
+                strategy, ', '.join(self.STRATEGIES)))
+        super(SQVDPool, self).__init__(username, password, hosts[0], version, calendar)
+        self.nodes = [_PoolNode(SQVD(username, password, host, version, calendar))
+                      for host in hosts]
+        for node in self.nodes:
+            node.client.password = self.password
+        self.strategy = strategy
+        self.maxFailures = maxFailures
+        self.ejectTime = ejectTime
+        self.healthInterval = healthInterval
+        self.healthTimeout = healthTimeout
+        self._lock = threading.Lock()
+        self._healthStop = threading.Event()
+        self._healthThread = None
+
+    def __enter__(self):
+        logged_in = self.login()
+        if not logged_in:
+            raise ApiError('Not authenticated, check credentials.')
+        return logged_in
+
+    def __str__(self):
+        return '<SQVDPool  '+self.username+'@'+','.join(n.client.host for n in self.nodes) + \
+            (' authenticated >' if self.session else ' >')
+
+    def login(self, username=None, password=None):
+        """Authenticates with every host, hosts that fail to log in are ejected
+
+        :param username: SQVD username.
+        :type username: str.
+        :param password: Plain text password
+        :type password: str.
+        :returns:  self if any host authenticated
+        """
+        if username:
+            self.username = username
+        if password:
+            self.password = hashlib.sha256(
+                password.encode('utf-8')).hexdigest()
+        self.session = None
+        for node in self.nodes:
+            node.client.username = self.username
+            node.client.password = self.password
+            if node.client.login():
+                self._reinstate(node)
+                self.session = node.client.session
+                self.userid = node.client.userid
+            else:
+                self._eject(node)
+        if self.session and self.healthInterval and not self._healthThread:
+            self._healthStop.clear()
+            self._healthThread = threading.Thread(target=self._healthLoop)
+            self._healthThread.daemon = True
+            self._healthThread.start()
+        return self if self.session else None
+
+    def logout(self):
+        """Logs out of every authenticated host
+
+        :returns:  bool -- true if all sucessful
+        """
+        if self._healthThread:
+            self._healthStop.set()
+            self._healthThread.join()
+            self._healthThread = None
+        success = True
+        for node in self.nodes:
+            if node.client.session:
+                try:
+                    success = bool(node.client.logout()) and success
+                except requests.RequestException:
+                    success = False
+        self.session = None
+        self.userid = None
+        return success
+
+    def _eject(self, node):
+        with self._lock:
+            node.ejected = time.time()
+            node.failures = 0
+        print('ERROR: ejected {} from pool'.format(node.client.host))
+
+    def _reinstate(self, node):
+        with self._lock:
+            node.ejected = None
+            node.failures = 0
+            node.latency = 0.0
+            # do not flood a reinstated host to catch up on request counts
+            node.requests = max(n.requests for n in self.nodes)
+
+    def _probe(self, node):
+        """Checks a host with a cheap authenticated request, logs in again if rejected
+
+        :param node: the host
+        :type node: _PoolNode.
+        :returns:  bool -- true if healthy
+        """
+        for attempt in range(2):
+            if not node.client.session and not node.client.login():
+                return False
+            try:
+                r = node.client.session.request(
+                    'GET', '/'.join([node.client.url, 'track']),
+                    params={'_id': '_healthcheck'}, timeout=self.healthTimeout)
+            except requests.RequestException:
+                return False
+            if r.status_code != 401:
+                return r.status_code < 500
+            if not node.client.login():
+                return False
+        return False
+
+    def checkHealth(self):
+        """Probes hosts in rotation and ejected hosts whose ejection time has passed
+
+        Runs in a background thread while logged in (see healthInterval).
+
+        :returns:  list -- healthy hosts
+        """
+        for node in self.nodes:
+            with self._lock:
+                ejected = node.ejected
+                if ejected:
+                    if time.time() - ejected < self.ejectTime:
+                        continue
+                    node.ejected = time.time()  # one probe per ejection period
+            healthy = self._probe(node)
+            if healthy and ejected:
+                self._reinstate(node)
+            elif healthy:
+                with self._lock:
+                    node.failures = 0
+            elif not ejected:
+                with self._lock:
+                    node.failures += 1
+                    eject = node.failures >= self.maxFailures
+                if eject:
+                    self._eject(node)
+        return [n.client.host for n in self.nodes if not n.ejected]
+
+    def _healthLoop(self):
+        while not self._healthStop.wait(self.healthInterval):
+            try:
+                self.checkHealth()
+            except Exception as e:
+                print('ERROR: health check failed ({})'.format(e))
+
+    def _acquire(self, exclude=()):
+        """Selects a host and increments its outstanding requests
+
+        :param exclude: hosts not to select
+        :type exclude: [_PoolNode].
+        :returns:  _PoolNode
+        :raises: ApiError if no host is available
+        """
+        with self._lock:
+            nodes = [n for n in self.nodes
+                     if not n.ejected and n.client.session and n not in exclude]
+            if not nodes:
+                raise ApiError('No SQVD host available')
+            if self.strategy == 'latency':
+                # hosts without measurements are assumed to be average
+                average = self._averageLatency()
+                node = min(nodes, key=lambda n: (
+                    (n.outstanding + 1) * (n.latency or average), n.outstanding, n.requests))
+            else:
+                node = min(nodes, key=lambda n: (n.outstanding, n.requests))
+            node.outstanding += 1
+            node.requests += 1
+        return node
+
+    def _averageLatency(self, exclude=None):
+        """mean latency estimate of measured hosts in rotation (0.0 if none)"""
+        measured = [n.latency for n in self.nodes
+                    if n.latency and not n.ejected and n is not exclude]
+        return sum(measured) / len(measured) if measured else 0.0
+
+    def _release(self, node, elapsed=None, failed=False, answered=True):
+        """Decrements outstanding requests and records latency or failure
+
+        :param node: the host
+        :type node: _PoolNode.
+        :param elapsed: request duration in seconds (updates latency estimate, always given for failures)
+        :type elapsed: float.
+        :param failed: request failed with a connection, server or authentication error
+        :type failed: bool.
+        :param answered: host responded regularly (resets failure count)
+        :type answered: bool.
+        """
+        eject = False
+        with self._lock:
+            node.outstanding -= 1
+            if failed:
+                node.failures += 1
+                eject = node.failures >= self.maxFailures
+                # penalise latency estimate so failing hosts are avoided
+                elapsed = max(elapsed or 0.0, self._averageLatency(node)) * \
+                    self.FAILUREPENALTY
+            elif answered:
+                node.failures = 0
+            if elapsed:
+                # exponentially weighted moving average
+                node.latency = elapsed if not node.latency else \
+                    0.7 * node.latency + 0.3 * elapsed
+        if eject:
+            self._eject(node)
+
+    def _dispatch(self, method, args, kwargs, failover=False, timed=False):
+        """Routes a call to a host of the pool
+
+        :param method: SQVD method name
+        :type method: str.
+        :param failover: retry on other hosts after host failures (idempotent calls only)
+        :type failover: bool.
+        :param timed: use call duration for latency estimate
+        :type timed: bool.
+        :returns:  return value of the SQVD method
+        """
+        tried = []
+        while True:
+            node = self._acquire(tried)
+            start = time.time()
+            try:
+                result = getattr(node.client, method)(*args, **kwargs)
+            except (requests.RequestException, ApiError) as e:
+                status = getattr(e, 'status', None)
+                elapsed = time.time() - start
+                if isinstance(e, ApiError) and not (status == 401 or (status or 0) >= 500):
+                    # client errors (4xx) and validation errors are not the host's fault
+                    self._release(node, elapsed if timed and status else None,
+                                  answered=bool(status))
+                    raise
+                self._release(node, elapsed, failed=True)
+                if status == 401:
+                    node.client.login()
+                tried.append(node)
+                if failover and len(tried) < len(self.nodes):
+                    continue
+                raise
+            except:
+                self._release(node, answered=False)
+                raise
+            self._release(node, time.time() - start if timed else None)
+            return result
+
+    def rest(self, collection, op='GET', data=None, json=None):
+        """Routes a REST call to a host (GET requests fail over to other hosts)
+
+        :param collection: collection/resource name.
+        :type collection: string
+        :param op: HTTP method
+        :type op: STRING.
+        :param data: Form Data
+        :type data: dict/string.
+        :param json: JSON Data, keys are sanitized for mongoDB
+        :type json: dict/json.
+        :returns: response object.
+        """
+        return self._dispatch('rest', (collection, op, data, json), {},
+                              failover=op == 'GET', timed=True)
+
+    def createStudy(self, x, find=False):
+        """Creates a new study on a single host (see SQVD.createStudy)
+
+        :param x: Dictionary with study/sample information.
+        :type x: dict
+        :param find: If study cannot be created find and return
+        :type find: bool -- default False
+        :returns:  dict -- the study document.
+        """
+        return self._dispatch('createStudy', (x, find), {})
+
+    def deleteStudy(self, study_name):
+        """Deletes a study and all associated assets on a single host (see SQVD.deleteStudy)
+
+        :param study_name: The study name
+        :type study_name: str
+
+        :returns: list
+        """
+        return self._dispatch('deleteStudy', (study_name,), {})
+
+    def upload(self, files, study_name, options={"import": "true"}):
+        """Adds files to a study on a single host (see SQVD.upload)
+
+        :param files: file paths
+        :type files: [str]
+        :param study_name: The study name
+        :type study_name: str
+        :param options: parameters to control downstream processing
+        :type options: dict
+
+        :returns: list of tuples (file, json response)
+        """
+        return self._dispatch('upload', (files, study_name, options), {})
+
+
 if __name__ == "__main__":
     import sys
     if (len(sys.argv) < 3):
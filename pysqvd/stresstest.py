@@ -0,0 +1,509 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Load generator for capacity testing of SQVD servers
+
+Drives a weighted mix of createStudy, upload, rest and deleteStudy calls
+either closed-loop (concurrency workers as fast as possible) or open-loop
+(Poisson arrivals at a fixed rate) and reports throughput and latency
+percentiles per operation. Runs against real servers or a local mock.
+
+    python -m pysqvd.stresstest --mock --rate 20 --duration 30
+"""
+from __future__ import print_function, division
+from six.moves import BaseHTTPServer, socketserver, queue
+from six.moves.urllib.parse import urlparse, parse_qsl
+import argparse
+import json
+import math
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from pysqvd import SQVD, SQVDPool, ApiError
+
+__author__ = "David Brawand"
+__credits__ = ['David Brawand']
+__license__ = "MIT"
+__maintainer__ = "David Brawand"
+__email__ = "dbrawand@nhs.net"
+
+OPERATIONS = ['createStudy', 'upload', 'rest', 'deleteStudy']
+PERCENTILES = [50, 90, 95, 99]
+VCF = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test', 'variants.vcf.gz')
+
+
+def percentile(values, p):
+    """Nearest rank percentile
+
+    >>> percentile(list(range(1, 11)), 50), percentile(list(range(1, 11)), 90)
+    (5, 9)
+    >>> percentile(list(range(1, 101)), 99), percentile(list(range(1, 101)), 100)
+    (99, 100)
+
+    :param values: sorted values
+    :type values: [float].
+    :param p: percentile (0-100)
+    :type p: float.
+    :returns:  float.
+    """
+    if not values:
+        return float('nan')
+    rank = int(math.ceil(p / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+def syntheticFiles(directory, intervals=1000, seed=None):
+    """Writes synthetic BED and bedgraph files
+
+    :param directory: output directory
+    :type directory: str.
+    :param intervals: number of intervals per file
+    :type intervals: int.
+    :param seed: random seed
+    :type seed: int.
+    :returns:  list -- file paths
+    """
+    rng = random.Random(seed)
+    bed = os.path.join(directory, 'stresstest.bed')
+    bedgraph = os.path.join(directory, 'stresstest.bedgraph')
+    with open(bed, 'w') as bfh, open(bedgraph, 'w') as gfh:
+        pos = 10000
+        for i in range(intervals):
+            start = pos + rng.randint(100, 5000)
+            end = start + rng.randint(50, 300)
+            pos = end
+            bfh.write('1\t{}\t{}\ttarget_{}\n'.format(start, end, i))
+            for s in range(start, end, 50):
+                gfh.write('1\t{}\t{}\t{}\n'.format(s, min(s + 50, end), rng.randint(0, 2000)))
+    return [bed, bedgraph]
+
+
+class _MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Minimal in-memory implementation of the SQVD REST and GraphQL endpoints"""
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, obj, status=200):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self):
+        """returns path components below the API root and query parameters"""
+        time.sleep(self.server.latency)
+        url = urlparse(self.path)
+        parts = [p for p in url.path.split('/') if p]
+        if parts[:2] == ['api', 'v1']:
+            parts = parts[2:]
+        return parts, dict(parse_qsl(url.query))
+
+    def do_GET(self):
+        parts, query = self._route()
+        db = self.server.db
+        with self.server.lock:
+            docs = db.get(parts[0], []) if parts else []
+            if len(parts) > 1:
+                docs = [d for d in docs if d['_id'] == parts[1]]
+            docs = [d for d in docs
+                    if all(str(d.get(k)) == v for k, v in query.items())]
+        self._send({'data': docs, 'userid': 'mock', 'querytime': 0,
+                    'requested': time.strftime('%Y-%m-%dT%H:%M:%S')})
+
+    def do_DELETE(self):
+        parts, _ = self._route()
+        with self.server.lock:
+            docs = self.server.db.setdefault(parts[0], [])
+            deleted = [d for d in docs if d['_id'] == parts[1]]
+            self.server.db[parts[0]] = [d for d in docs if d['_id'] != parts[1]]
+        self._send({'data': deleted})
+
+    def do_POST(self):
+        parts, _ = self._route()
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if parts == ['login']:
+            return self._send({'data': {'userId': 'mock', 'authToken': uuid.uuid4().hex}})
+        if parts == ['logout']:
+            return self._send({'data': {}})
+        if parts == ['graphql']:
+            m = re.search(r'deleteStudy\(study_id: \\?"([^"\\]+)', body.decode('utf-8'))
+            with self.server.lock:
+                self.server.db['study'] = [d for d in self.server.db['study']
+                                           if not m or d['_id'] != m.group(1)]
+            return self._send({'data': {'deleteStudy': True}})
+        if len(parts) == 3:  # file upload
+            return self._send({'data': {'bytes': len(body), 'filetype': parts[2]}})
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            doc = json.loads(body.decode('utf-8'))
+        else:
+            doc = dict(parse_qsl(body.decode('utf-8')))
+        doc['_id'] = uuid.uuid4().hex[:17]
+        with self.server.lock:
+            self.server.db.setdefault(parts[0], []).append(doc)
+        self._send({'data': doc})
+
+
+class MockServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, panel_id, panel_version, workflow, group, latency=0.0, port=0):
+        """creates an in-memory SQVD mock server on localhost
+
+        :param panel_id: panel to provide
+        :type panel_id: str.
+        :param panel_version: panel version to provide
+        :type panel_version: int.
+        :param workflow: workflow (track) name to provide
+        :type workflow: str.
+        :param group: group of panel
+        :type group: str.
+        :param latency: simulated server time per request in seconds
+        :type latency: float.
+        :param port: port to listen on (0 picks a free port)
+        :type port: int.
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), _MockHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.db = {
+            'panel': [{'_id': 'mockpanel', 'panel_id': panel_id, 'panel_version': panel_version,
+                       'tat': 5, 'subpanels': [], 'group': group, 'track_id': 'mocktrack'}],
+            'track': [{'_id': 'mocktrack', 'name': workflow}],
+            'study': [], 'sample': [], 'dataset': []
+        }
+
+    @property
+    def host(self):
+        return '{}:{}'.format(*self.server_address[:2])
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+class LoadGenerator(object):
+
+    def __init__(self, sqvd, study, files, weights=None, concurrency=4, rate=None, seed=None):
+        """creates a load generator
+
+        :param sqvd: authenticated client
+        :type sqvd: SQVD/SQVDPool.
+        :param study: study template (panel_id, panel_version, workflow, subpanels, group)
+        :type study: dict.
+        :param files: files to upload per upload operation
+        :type files: [str].
+        :param weights: relative frequency of each operation
+        :type weights: dict -- {operation: weight}.
+        :param concurrency: number of worker threads
+        :type concurrency: int.
+        :param rate: open-loop arrival rate in operations/s (None for closed-loop)
+        :type rate: float.
+        :param seed: random seed
+        :type seed: int.
+        """
+        self.sqvd = sqvd
+        self.study = study
+        self.files = files
+        self.weights = weights or {'createStudy': 2, 'upload': 2, 'rest': 5, 'deleteStudy': 1}
+        self.concurrency = concurrency
+        self.rate = rate
+        self.rng = random.Random(seed)
+        self.prefix = 'stresstest_{}_'.format(uuid.uuid4().hex[:8])
+        self.counter = 0
+        self.studies = []  # created and not yet deleted
+        self.uploaded = set()
+        self.issued = dict((op, 0) for op in OPERATIONS)
+        self.latencies = dict((op, []) for op in OPERATIONS)
+        self.errors = dict((op, 0) for op in OPERATIONS)
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def _choose(self):
+        """picks the next operation and its study
+
+        Operations without a suitable study (upload, deleteStudy) are left out
+        of the draw. If no weighted operation is possible a study is created.
+        """
+        with self._lock:
+            candidates = [s for s in self.studies if s not in self.uploaded]
+            possible = {'createStudy': True, 'upload': bool(candidates),
+                        'deleteStudy': bool(self.studies), 'rest': True}
+            ops = [op for op in OPERATIONS if self.weights.get(op) and possible[op]]
+            op = 'createStudy'
+            r = self.rng.uniform(0, sum(self.weights[o] for o in ops))
+            for op in ops:
+                r -= self.weights[op]
+                if r <= 0:
+                    break
+            self.issued[op] += 1
+            if op == 'upload':
+                # not available for deletion while uploading
+                name = self.rng.choice(candidates)
+                self.studies.remove(name)
+                self.uploaded.add(name)
+                return op, name
+            elif op == 'deleteStudy':
+                name = self.studies.pop(self.rng.randrange(len(self.studies)))
+                return op, name
+            elif op == 'rest':
+                return op, self.rng.choice(self.studies) if self.studies else None
+            self.counter += 1
+            return op, self.prefix + str(self.counter)
+
+    def _execute(self, op, name):
+        """runs a single operation"""
+        if op == 'createStudy':
+            x = dict(self.study)
+            x.update({'study_name': name, 'sample_id': name, 'dataset_name': ''})
+            self.sqvd.createStudy(x)
+            with self._lock:
+                self.studies.append(name)
+        elif op == 'upload':
+            try:
+                # study lookup failures and rejected files are printed, not raised
+                uploaded = self.sqvd.upload(self.files, name)
+            finally:
+                with self._lock:
+                    self.studies.append(name)
+            if uploaded is None or len(uploaded) != len(self.files):
+                raise ApiError('uploaded {} of {} files'.format(
+                    len(uploaded or []), len(self.files)))
+        elif op == 'deleteStudy':
+            if self.sqvd.deleteStudy(name) is None:
+                raise ApiError('study not found or ambiguous')
+        elif name:
+            self.sqvd.rest('study', data={'study_name': name})
+        else:
+            self.sqvd.rest('panel', data={k: self.study[k] for k in ('panel_id', 'panel_version')})
+
+    def _run(self, op, name, scheduled=None):
+        """runs an operation and records latency from its scheduled start"""
+        scheduled = scheduled or time.time()
+        failed = False
+        try:
+            self._execute(op, name)
+        except Exception as e:
+            failed = True
+            print('ERROR: {} {} ({})'.format(op, name, e))
+        latency = time.time() - scheduled
+        with self._lock:
+            if failed:
+                self.errors[op] += 1
+            else:
+                self.latencies[op].append(latency)
+
+    def run(self, duration=None, operations=None):
+        """generates load until duration or number of operations is reached
+
+        In open-loop mode latencies include time queued for a free worker.
+
+        :param duration: seconds to run
+        :type duration: float.
+        :param operations: number of operations to run
+        :type operations: int.
+        :returns:  dict -- report
+        """
+        if not duration and not operations:
+            raise ValueError('duration or operations required')
+        start = time.time()
+        end = start + duration if duration else None
+        tasks = queue.Queue(maxsize=0 if self.rate else self.concurrency)
+
+        def worker():
+            while True:
+                task = tasks.get()
+                if task is None:
+                    return
+                self._run(*task)
+
+        threads = [threading.Thread(target=worker) for _ in range(self.concurrency)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        issued = 0
+        scheduled = start
+        while not operations or issued < operations:
+            if self.rate:
+                # poisson arrivals independent of response times
+                scheduled += self.rng.expovariate(self.rate)
+            else:
+                scheduled = time.time()
+            if end and scheduled >= end:
+                break
+            wait = scheduled - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            op, name = self._choose()
+            # blocks in closed-loop mode, latency is then measured by the worker
+            tasks.put((op, name, scheduled if self.rate else None))
+            issued += 1
+        for t in threads:
+            tasks.put(None)
+        for t in threads:
+            t.join()
+        self.elapsed = time.time() - start
+        return self.report()
+
+    def cleanup(self):
+        """deletes all studies that are still present
+
+        :returns:  int -- number of deleted studies
+        """
+        deleted = 0
+        while self.studies:
+            name = self.studies.pop()
+            try:
+                if self.sqvd.deleteStudy(name) is not None:
+                    deleted += 1
+            except Exception as e:
+                print('ERROR: cleanup of {} failed ({})'.format(name, e))
+        return deleted
+
+    def report(self):
+        """throughput, latency percentiles and requested/issued share per operation
+
+        :returns:  dict -- {operation: {count, errors, throughput, requested, issued, p50, .., max}}
+        """
+        report = {}
+        weights = sum(self.weights.get(op, 0) for op in OPERATIONS)
+        issued = sum(self.issued.values())
+        for op in OPERATIONS:
+            values = sorted(self.latencies[op])
+            if not values and not self.errors[op]:
+                continue
+            stats = {
+                'count': len(values),
+                'errors': self.errors[op],
+                'throughput': len(values) / self.elapsed if self.elapsed else 0.0,
+                'mean': sum(values) / len(values) if values else float('nan'),
+                'max': values[-1] if values else float('nan'),
+                'requested': self.weights.get(op, 0) / weights if weights else 0.0,
+                'issued': self.issued[op] / issued if issued else 0.0
+            }
+            for p in PERCENTILES:
+                stats['p{}'.format(p)] = percentile(values, p)
+            report[op] = stats
+        return report
+
+
+def formatReport(report, elapsed):
+    """formats a report as a table (latencies in ms)
+
+    :param report: LoadGenerator report
+    :type report: dict.
+    :param elapsed: run time in seconds
+    :type elapsed: float.
+    :returns:  str.
+    """
+    columns = ['count', 'errors', 'throughput', 'mean'] + \
+        ['p{}'.format(p) for p in PERCENTILES] + ['max']
+    lines = ['{:<12}'.format('operation') + ''.join('{:>11}'.format(c) for c in columns)]
+    total = 0
+    for op in OPERATIONS:
+        if op not in report:
+            continue
+        stats = report[op]
+        total += stats['count']
+        line = '{:<12}{:>11}{:>11}{:>11.2f}'.format(
+            op, stats['count'], stats['errors'], stats['throughput'])
+        line += ''.join('{:>11.1f}'.format(stats[c] * 1000) for c in columns[3:])
+        lines.append(line)
+    lines.append('{} operations in {:.1f}s ({:.2f}/s)'.format(
+        total, elapsed, total / elapsed if elapsed else 0.0))
+    lines.append('mix requested/issued: ' + ', '.join(
+        '{} {:.0%}/{:.0%}'.format(op, report[op]['requested'], report[op]['issued'])
+        for op in OPERATIONS if op in report))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Load generator for SQVD (credentials from SQVDUSER, SQVDPASS, hosts from SQVDHOST)')
+    parser.add_argument('--host', action='append', default=[],
+                        help='SQVD host, repeat for a pool (default: $SQVDHOST)')
+    parser.add_argument('--mock', action='store_true', help='run against a local mock server')
+    parser.add_argument('--mock-latency', type=float, default=0.005,
+                        help='simulated mock server time per request in seconds')
+    parser.add_argument('--strategy', default='outstanding', choices=SQVDPool.STRATEGIES,
+                        help='host selection for multiple hosts')
+    parser.add_argument('--duration', type=float, default=60, help='seconds to run')
+    parser.add_argument('--operations', type=int, help='stop after this number of operations')
+    parser.add_argument('--concurrency', type=int, default=4, help='worker threads')
+    parser.add_argument('--rate', type=float,
+                        help='open-loop arrival rate in operations/s (default: closed-loop)')
+    parser.add_argument('--mix', default='createStudy=2,upload=2,rest=5,deleteStudy=1',
+                        help='relative operation weights')
+    parser.add_argument('--intervals', type=int, default=1000,
+                        help='intervals in synthetic BED/bedgraph files')
+    parser.add_argument('--panel', default='CRCP', help='panel_id of created studies')
+    parser.add_argument('--panel-version', type=int, default=1)
+    parser.add_argument('--workflow', default='dna_somatic')
+    parser.add_argument('--group', default='advdiag')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--json', action='store_true', help='print report as JSON')
+    args = parser.parse_args(argv)
+
+    try:
+        weights = dict((k, float(v)) for k, v in (w.split('=') for w in args.mix.split(',')))
+        assert set(weights) <= set(OPERATIONS) and sum(weights.values()) > 0
+    except (ValueError, AssertionError):
+        parser.error('--mix must be like ' + parser.get_default('mix'))
+
+    user = os.environ.get('SQVDUSER', 'admin' if args.mock else None)
+    passwd = os.environ.get('SQVDPASS', 'admin' if args.mock else None)
+    if not (user and passwd):
+        parser.error('SQVDUSER and SQVDPASS must be set (or use --mock)')
+    hosts = args.host or [h for h in os.environ.get('SQVDHOST', '').split(',') if h]
+    mock = None
+    if args.mock:
+        mock = MockServer(args.panel, args.panel_version, args.workflow, args.group,
+                          args.mock_latency).start()
+        hosts = [mock.host]
+    if not hosts:
+        parser.error('no host given (--host, SQVDHOST or --mock)')
+
+    if len(hosts) > 1:
+        sqvd = SQVDPool(username=user, password=passwd, hosts=hosts, strategy=args.strategy)
+    else:
+        sqvd = SQVD(username=user, password=passwd, host=hosts[0])
+
+    workdir = tempfile.mkdtemp(prefix='sqvdstress')
+    try:
+        files = [VCF] + syntheticFiles(workdir, args.intervals, args.seed)
+        study = {
+            'panel_id': args.panel,
+            'panel_version': args.panel_version,
+            'workflow': args.workflow,
+            'subpanels': [],
+            'group': args.group
+        }
+        with sqvd:
+            generator = LoadGenerator(sqvd, study, files, weights, args.concurrency,
+                                      args.rate, args.seed)
+            try:
+                report = generator.run(args.duration, args.operations)
+            finally:
+                print('Cleaning up {} studies'.format(len(generator.studies)))
+                generator.cleanup()
+    finally:
+        shutil.rmtree(workdir)
+        if mock:
+            mock.shutdown()
+
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print(formatReport(report, generator.elapsed))
+
+
+if __name__ == "__main__":
+    main()
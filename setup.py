@@ -8,6 +8,10 @@ setup(name='pysqvd',
   author_email='dbrawand@nhs.net',
   license='Apache 2.0',
   packages=['pysqvd'],
+  package_data={'pysqvd': ['test/variants.vcf.gz']},
+  entry_points={
+    'console_scripts': ['sqvd-stresstest=pysqvd.stresstest:main']
+  },
   install_requires=[
     "requests",
     "six"